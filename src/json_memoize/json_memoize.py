@@ -1,57 +1,167 @@
 # MIT License
 # Phil Davis, 2021
 
+import atexit
+import hashlib
+import inspect
 import json
 import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
 
-from datetime import datetime, timezone
-from functools import partial, wraps
+from functools import lru_cache, partial, wraps
 from pathlib import Path
 from typing import Any, Callable, Optional
 
 from appdirs import AppDirs
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+else:
+    # Fallback for when the optional orjson speedup is not installed.
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    _loads = json.loads
+
+# Use counters are halved across the board once any of them reaches this
+# ceiling, so relative usage is preserved without unbounded growth.
+_COUNTER_CEILING = 2 ** 31
+
+
 def memoize(
         func: Callable = None,
         max_age: int = 0,
         max_size: int = 0,
         force_update: bool = False,
         app_name: str = None,
-        cache_folder_path: Path = None,        
-        cache_file_name: str = None        
+        cache_folder_path: Path = None,
+        cache_file_name: str = None,
+        flush_every: int = 64,
+        use_json: bool = False
     ) -> Any:
         if func is None:
-            return partial(memoize, cache_folder_path=cache_folder_path, app_name=app_name, cache_file_name=cache_file_name, max_age=max_age, max_size=max_size, force_update=force_update)
+            return partial(memoize, cache_folder_path=cache_folder_path, app_name=app_name, cache_file_name=cache_file_name, max_age=max_age, max_size=max_size, force_update=force_update, flush_every=flush_every, use_json=use_json)
+        # The cache is created once at decoration time and shared by every call,
+        # so setup happens once and size/age limits are enforced in batches
+        # when the cache flushes.
+        cache_folder = _construct_cache_folder_path(cache_folder_path, app_name)
+        file_name = cache_file_name or f"{func.__name__}_cache"
+        cache_file_path = cache_folder / file_name
+        cache = JsonCache(cache_file_path, max_size=max_size, max_age=max_age, force_update=force_update, use_json=use_json)
+        cache.read_file()
+        atexit.register(cache.close)
+        calls_since_flush = 0
+        # Pre-bound methods keep the per-call path to plain local loads,
+        # skipping the attribute lookups the wrapper would otherwise repeat
+        # on every invocation.
+        cache_contains = cache.__contains__
+        cache_store = cache.store
+        cache_retrieve = cache.retrieve
+        cache_flush = cache.flush
+        warning_enabled = logging.getLogger().isEnabledFor
+        # If the signature only admits primitive arguments, the repr warning
+        # can never fire, so the per-call check is compiled out here.
+        check_for_reprs = _needs_repr_check(func)
         @wraps(func)
         def cache_wrapper(*args, **kwargs):
-            cache_folder = _construct_cache_folder_path(cache_folder_path, app_name)
-            file_name = cache_file_name or f"{func.__name__}_cache"
-            cache_file_path = Path(cache_folder) / file_name
-            for arg in [*args, *kwargs.keys(), *kwargs.values()]:
-                _warn_if_repr(arg)
-                """
-                if "__str__" in dir(object)
-                """
-            call_string = f"{args}, {kwargs}"
-            with JsonCache(cache_file_path, max_size=max_size, max_age=max_age, force_update=force_update) as cache:
-                if call_string not in cache:
-                    cache.store(call_string, func(*args, **kwargs))
-                    logging.info("%s cached", call_string)
-                return cache.retrieve(call_string)
+            nonlocal calls_since_flush
+            if check_for_reprs and warning_enabled(logging.WARNING):
+                for arg in [*args, *kwargs.keys(), *kwargs.values()]:
+                    _warn_if_repr(arg)
+            call_string = _make_call_key(args, kwargs)
+            if cache_contains(call_string):
+                try:
+                    response = cache_retrieve(call_string)
+                except KeyError:
+                    # Another process sharing the file can evict the entry
+                    # between the membership check and the read; treat the
+                    # vanished row as an ordinary miss.
+                    response = func(*args, **kwargs)
+                    cache_store(call_string, response)
+            else:
+                response = func(*args, **kwargs)
+                cache_store(call_string, response)
+                logging.info("%s cached", call_string)
+            calls_since_flush += 1
+            if calls_since_flush >= flush_every:
+                cache_flush()
+                calls_since_flush = 0
+            return response
         return cache_wrapper
 
 
+_PRIMITIVE_TYPES = (str, int, float, bool, bytes, type(None))
+
+_SAFE_ANNOTATIONS = {str, int, float, bool, bytes, tuple, list, dict, type(None)}
+_SAFE_ANNOTATION_NAMES = {safe_type.__name__ for safe_type in _SAFE_ANNOTATIONS} | {"None"}
+
+
+def _needs_repr_check(func: Callable) -> bool:
+    """
+    Returns False if every parameter of func is annotated with a primitive
+    builtin type. Builtins stringify to their values, never to a repr, so
+    the per-call repr warning loop can be skipped for such functions.
+    """
+    try:
+        parameters = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return True
+    for parameter in parameters:
+        annotation = parameter.annotation
+        if annotation is inspect.Parameter.empty:
+            return True
+        # Annotations may be strings under deferred evaluation.
+        if isinstance(annotation, str):
+            if annotation not in _SAFE_ANNOTATION_NAMES:
+                return True
+        elif annotation not in _SAFE_ANNOTATIONS:
+            return True
+    return False
+
+
+def _make_call_key(args: tuple, kwargs: dict) -> str:
+    """
+    Builds a stable cache key from the arguments of a call.
+    Single primitive arguments are used directly; anything else is digested
+    from a canonical JSON form, so keys are cheap, order-independent for
+    kwargs, and cannot collide across differently shaped argument lists.
+    """
+    if len(args) == 1 and not kwargs and type(args[0]) in _PRIMITIVE_TYPES:
+        return repr(args[0])
+    try:
+        canonical = json.dumps([args, sorted(kwargs.items())], default=repr, sort_keys=True)
+    except TypeError:
+        # default=repr never applies to dict keys, so non-string keys (or
+        # mixed key types under sort_keys) are not JSON-canonicalizable.
+        # Fall back to repr of the whole call; it handles any arguments.
+        canonical = repr((args, sorted(kwargs.items())))
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
 def _warn_if_repr(item: Any) -> None:
     """Logs a warning if a call to the supplied item's __str__ returns something that looks like a __repr__ output."""
     str_rep = str(item)
-    if "<" in str_rep and ">" in str_rep:
+    if str_rep.startswith("<") and str_rep.endswith(">"):
         logging.warn("%s <-- This looks like it might be a repr output. Cache may not behave as expected.", str_rep)
 
 
+@lru_cache(maxsize=32)
 def _construct_cache_folder_path(cache_folder_path: Optional[Path], app_name: Optional[str]) -> Path:
     """
     Uses supplied arguments to construct a Path to a folder.
     If no information is provided, loggs a warning and uses a default value.
+    The result is pure in its arguments, so it is memoized to skip the
+    AppDirs platform lookup on repeat calls.
     """
     if cache_folder_path is not None and cache_folder_path:
         return Path(cache_folder_path)
@@ -64,117 +174,213 @@ def _construct_cache_folder_path(cache_folder_path: Optional[Path], app_name: Op
 
 def make_timestamp() -> float:
     """Returns a POSIX UTC timestamp."""
-    return datetime.now(timezone.utc).timestamp()
+    return time.time()
 
 
 class JsonCache:
     """
-    Creates a persistent JSON based cache.
+    Creates a persistent cache backed by a SQLite database, with pickled values (json values on request).
     Intended to be performant relative to a potentially slow API, not relative to built in lru_cache or similar.
-    N.B. Rules for max size and max age are enforced when the file is saved, but the cache object may exceed limits while it is live in memory.
+    Safe to share across threads; all database access is serialized behind a lock.
+    N.B. Rules for max size and max age are enforced when the cache flushes, but the table may exceed limits between flushes.
     """
-    
-    def __init__(self, cache_file_path: Path, max_size: int = 0, max_age: int = 0, force_update: bool = False) -> None:        
+
+    __slots__ = (
+        "cache_file_path",
+        "max_size",
+        "max_age",
+        "force_update",
+        "reclaim",
+        "use_json",
+        "_value_dumps",
+        "_value_loads",
+        "_lock",
+        "_connection",
+    )
+
+    def __init__(self, cache_file_path: Path, max_size: int = 0, max_age: int = 0, force_update: bool = False, reclaim: float = 0.1, use_json: bool = False) -> None:
         """
-        Allows for persistent memoization of a function using a .json file.
+        Allows for persistent memoization of a function using a cache file.
 
         Keyword Arguments:
          - cache_file_path: a Path object pointing to the associated cache file
          - max_size: the maximum number of items the cache can store. 0 disables size checking. (default = 0)
-         - max_age: the maximum age in seconds after which a cahced value must be replaced. 0 disables age checking. (default = 0)  
+         - max_age: the maximum age in seconds after which a cahced value must be replaced. 0 disables age checking. (default = 0)
          - force_update: if set to True, fresh calls will be made regardless of cached status. (default = False)
+         - reclaim: the fraction of max_size evicted beyond the overflow when the cache exceeds max_size. (default = 0.1)
+         - use_json: if set to True, values are stored as json rather than pickle. Slower and less faithful for rich
+           Python objects, but never executes stored data on load. (default = False)
         """
         self.cache_file_path = cache_file_path
         self.max_size = max_size
         self.max_age = max_age
         self.force_update = force_update
-        self.cache: dict = {}
-        
+        self.reclaim = reclaim
+        self.use_json = use_json
+        if use_json:
+            self._value_dumps = _dumps
+            self._value_loads = _loads
+        else:
+            self._value_dumps = partial(pickle.dumps, protocol=5)
+            self._value_loads = pickle.loads
+        # Reentrant because the locked methods call each other (e.g. an
+        # eviction pass takes the table size).
+        self._lock = threading.RLock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Returns the database connection, opening it on first use.
+        A file that is not a cache database - including the pre-SQLite cache
+        formats - is removed and started fresh. Transient failures such as a
+        locked database or an unopenable path are re-raised untouched; they
+        do not mean the file is bad, and removing it would destroy a cache
+        another connection is still using.
+        """
+        with self._lock:
+            if self._connection is None:
+                if not self.cache_file_path.parent.exists():
+                    self.cache_file_path.parent.mkdir(parents=True)
+                try:
+                    self._connection = self._open_db()
+                except sqlite3.OperationalError:
+                    # "database is locked", "unable to open database file", etc.
+                    raise
+                except sqlite3.DatabaseError:
+                    # Not a database, or corrupt: drop it and recompute.
+                    if not self.cache_file_path.is_file():
+                        raise
+                    os.remove(self.cache_file_path)
+                    self._connection = self._open_db()
+            return self._connection
+
+    def _open_db(self) -> sqlite3.Connection:
+        """Opens the database file and prepares its pragmas and schema."""
+        # Autocommit keeps every write a single short WAL transaction.
+        # Deferring commits to flush would hold the write lock across up to
+        # flush_every calls and stall any other process sharing the file.
+        # The same-thread check is disabled so a function memoized at import
+        # time can be called from worker threads; every use of the connection
+        # holds _lock, so it is never touched by two threads at once.
+        connection = sqlite3.connect(self.cache_file_path, isolation_level=None, check_same_thread=False)
+        try:
+            # WAL keeps single-row writes cheap and crash-safe, with no
+            # full-file rewrites ever.
+            connection.execute("PRAGMA journal_mode=WAL")
+            expected_version = 2 if self.use_json else 1
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version and version != expected_version:
+                # The table was written with the other value serializer; its
+                # rows cannot be read, so they are dropped and recomputed.
+                connection.execute("DROP TABLE IF EXISTS cache")
+            connection.execute(f"PRAGMA user_version = {expected_version}")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value BLOB, ts REAL, deadline REAL, counter INTEGER NOT NULL DEFAULT 0)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_deadline ON cache(deadline)")
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_counter ON cache(counter)")
+        except sqlite3.DatabaseError:
+            connection.close()
+            raise
+        return connection
+
     def store(self, call: str, response: Any) -> None:
-        """Stores the supplied call and response in the cache."""        
-        self.cache[call] = (response, make_timestamp())
+        """Stores the supplied call and response in the cache."""
+        timestamp = make_timestamp()
+        deadline = timestamp + self.max_age if self.max_age else None
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO cache (key, value, ts, deadline, counter) VALUES (?, ?, ?, ?, 0)",
+                (call, self._value_dumps(response), timestamp, deadline),
+            )
 
     def retrieve(self, call: str) -> Any:
-        """Returns the response value of the supplied cached call."""
-        return self.cache[call][0]
-
-    def _purge_expired(self) -> None:
-        """Deletes all entries older than max_age"""
-        if not self.max_age:
-            return
-        old_calls = [call for call in self.cache if self._age_check(call) > self.max_age]
-        for call in old_calls:
-            self.cache.pop(call)
-
-    def _age_check(self, call: str) -> float:
-        """Returns the age in seconds of the supplied call in the cache."""
-        return make_timestamp() - self.cache[call][-1]
-    
-    def _is_current(self, call: str) -> bool:
+        """Returns the response value of the supplied cached call, and counts the use."""
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT value, counter FROM cache WHERE key = ?", (call,)).fetchone()
+            if row is None:
+                raise KeyError(call)
+            value, counter = row
+            if counter >= _COUNTER_CEILING:
+                self._halve_counters()
+            connection.execute("UPDATE cache SET counter = counter + 1 WHERE key = ?", (call,))
+        return self._value_loads(value)
+
+    def _halve_counters(self) -> None:
+        """Halves every use counter, preserving relative usage while preventing unbounded growth."""
+        with self._lock:
+            self._connect().execute("UPDATE cache SET counter = counter / 2")
+
+    def _evict_pass(self) -> None:
         """
-        Returns True if the supplied call is current in the cache.
-        If force_update is set to True, always returns False. If max_age is 0, always returns True.
+        Deletes expired entries, then trims the cache to size.
+        Both deletes run against indexed columns, so neither scans the table.
         """
-        if self.force_update:
-            return False
-        if not self.max_age:
-            return True
-        return self._age_check(call) < self.max_age
-
-    def _purge_n_oldest(self, count:int = 1) -> None:
-        """Deletes the oldest n entry in the cache."""
-        sorted_entries = sorted(self.cache.items(), key=lambda x: x[-1][-1])
-        # Entries in the cache are stored in the form {call: (response, timestamp)}
-        # so x[-1][-1] refers to an entry's timestamp
-        for entry in sorted_entries[:count]:
-            self.cache.pop(entry[0])
-    
-    def _cull_to_size(self) -> None:
-        """Determines if max_size has been exceeded, and if so deletes the oldest entries until the size of the cache is complient."""
-        if not self.max_size:
-            return
-        if len(self.cache) > self.max_size:
-            self._purge_n_oldest(len(self.cache) - self.max_size)
-    
-    def write_file(self) -> None:
-        """Writes the contents of the cahce to a json file."""
-        if not self.cache_file_path.parent.exists():
-            self.cache_file_path.parent.mkdir(parents=True)
-        with open(self.cache_file_path, "w") as cache_file:
-            json.dump(self.cache, cache_file)
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM cache WHERE deadline IS NOT NULL AND deadline <= ?", (make_timestamp(),))
+            if self.max_size:
+                size = len(self)
+                if size > self.max_size:
+                    # Evict the overflow plus reclaim * max_size in one batch, so
+                    # eviction is amortized over many insertions. Ties on use
+                    # count fall back to evicting the oldest entries first.
+                    count = max(1, size - self.max_size + int(self.max_size * self.reclaim))
+                    connection.execute(
+                        "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY counter, ts LIMIT ?)",
+                        (count,),
+                    )
+
+    def flush(self) -> None:
+        """Enforces age and size limits on the stored entries."""
+        self._evict_pass()
+
+    def close(self) -> None:
+        """Flushes the cache and closes the database connection."""
+        with self._lock:
+            if self._connection is None:
+                return
+            self.flush()
+            self._connection.close()
+            self._connection = None
 
     def read_file(self) -> None:
-        """Opens the associated cache file, and loads the file's contents to the cache dict."""
-        if not self.cache_file_path.exists():
-            self.cache = dict()
-            return
-        with open(self.cache_file_path, "r") as cache_file:
-            contents = cache_file.read()
-            if contents:
-                self.cache = json.loads(contents)
-            else:
-                self.cache = dict()
+        """Opens the backing database. Rows load lazily as they are retrieved."""
+        self._connect()
+
+    def write_file(self) -> None:
+        """Kept for compatibility with the file-rewriting interface; writes now commit as they are made."""
 
     def __contains__(self, item):
-        return item in self.cache and self._is_current(item)
+        # Membership is the hottest check in the wrapper, so the whole
+        # currency test is inlined here: one query, no helper frames.
+        # force_update makes every entry stale; entries without a deadline
+        # are always current.
+        if self.force_update:
+            return False
+        with self._lock:
+            row = self._connect().execute("SELECT deadline FROM cache WHERE key = ?", (item,)).fetchone()
+        return row is not None and (row[0] is None or row[0] > time.time())
 
     def __len__(self):
-        return len(self.cache)
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
 
     def __repr__(self) -> str:
         return f"<JsonCache object at {hex(id(self))} storing {len(self)} items>"
 
     def __str__(self) -> str:
-        return str(self.cache)
+        with self._lock:
+            return str([row[0] for row in self._connect().execute("SELECT key FROM cache")])
 
     def __enter__(self):
         self.read_file()
         return self
-        
+
     def __exit__(self, *args, **kwargs):
-        self._purge_expired()
-        self._cull_to_size()
-        self.write_file()
+        self.flush()
 
 
 class JsonMemoize:
@@ -182,6 +388,18 @@ class JsonMemoize:
     A class used to establish default values for memoizing functions.
     Arguments supplied here will be used as defaults if no value is supplied to the decorator.
     """
+
+    __slots__ = (
+        "app_name",
+        "cache_folder_path",
+        "cache_file_name",
+        "max_age",
+        "max_size",
+        "force_update",
+        "flush_every",
+        "use_json",
+    )
+
     def __init__(
         self,
         app_name: str = None,
@@ -189,7 +407,9 @@ class JsonMemoize:
         cache_file_name: str = None,
         max_age: int = 0,
         max_size: int = 0,
-        force_update: bool = False
+        force_update: bool = False,
+        flush_every: int = 64,
+        use_json: bool = False
     ) -> None:
         self.app_name = app_name
         self.cache_folder_path = cache_folder_path
@@ -197,6 +417,8 @@ class JsonMemoize:
         self.max_age = max_age
         self.max_size = max_size
         self.force_update = force_update
+        self.flush_every = flush_every
+        self.use_json = use_json
         
         #construct a partial of memoize using supplied values
         #passed_args = {k: v for k, v in self.__dict__.items() if v is not None}
@@ -210,6 +432,8 @@ class JsonMemoize:
         app_name: str = None,
         cache_folder_path: Path = None,
         cache_file_name: str = None,
+        flush_every: int = None,
+        use_json: bool = None,
     ) -> Any:
         """
         Memoize the decorated functions using the default values with which this object was instantiated.
@@ -226,6 +450,10 @@ class JsonMemoize:
             cache_folder_path = self.cache_folder_path
         if cache_file_name is None:
             cache_file_name = self.cache_file_name
+        if flush_every is None:
+            flush_every = self.flush_every
+        if use_json is None:
+            use_json = self.use_json
 
         return memoize(
             func,
@@ -233,8 +461,10 @@ class JsonMemoize:
             max_size = max_size,
             force_update = force_update,
             app_name = app_name,
-            cache_folder_path = cache_folder_path, 
+            cache_folder_path = cache_folder_path,
             cache_file_name = cache_file_name,
+            flush_every = flush_every,
+            use_json = use_json,
         )
 
 
@@ -7,10 +7,13 @@
 # give it nothing
 # - It should warn you!
 
+import sqlite3
+import tempfile
+import threading
 import time
 import timeit
 
-from src.json_memoize.json_memoize import JsonCache, memoize, JsonMemoize
+from src.json_memoize.json_memoize import JsonCache, memoize, JsonMemoize, _make_call_key
 from pathlib import Path
 
 def fast_call(*args, **kwargs):
@@ -22,6 +25,76 @@ def slow_call(*args, **kwargs):
 
 #print(timeit.timeit('slow_call()',setup='from __main__ import  slow_call', number=1))
 
+def test_connect_recovers_from_corrupt_file():
+    cache_path = Path(tempfile.mkdtemp()) / "corrupt_cache"
+    cache_path.write_bytes(b"this is not a database")
+    cache = JsonCache(cache_path)
+    cache.read_file()
+    cache.store("a", 1)
+    assert cache.retrieve("a") == 1
+    cache.close()
+
+def test_connect_does_not_delete_on_transient_error():
+    # A path that cannot be opened as a database is not a corrupt cache,
+    # so it must be left alone and the error must surface.
+    blocked_path = Path(tempfile.mkdtemp()) / "blocked_cache"
+    blocked_path.mkdir()
+    cache = JsonCache(blocked_path)
+    try:
+        cache.read_file()
+    except sqlite3.OperationalError:
+        pass
+    else:
+        assert False, "expected an OperationalError"
+    assert blocked_path.exists()
+
+def test_two_caches_can_share_a_file():
+    # Writes must commit as they are made; an open write transaction on the
+    # first connection would stall the second for the busy timeout.
+    cache_path = Path(tempfile.mkdtemp()) / "shared_cache"
+    first = JsonCache(cache_path)
+    first.read_file()
+    first.store("a", 1)
+    second = JsonCache(cache_path)
+    second.read_file()
+    second.store("b", 2)
+    assert second.retrieve("a") == 1
+    assert first.retrieve("b") == 2
+    first.close()
+    second.close()
+
+def test_cache_usable_from_another_thread():
+    # The connection is opened on the importing thread; calls from worker
+    # threads must still work.
+    cache_path = Path(tempfile.mkdtemp()) / "threaded_cache"
+    cache = JsonCache(cache_path)
+    cache.read_file()
+    errors = []
+    def worker():
+        try:
+            cache.store("a", 1)
+            assert cache.retrieve("a") == 1
+        except Exception as error:
+            errors.append(error)
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert not errors
+    cache.close()
+
+def test_call_key_distinguishes_arg_shapes():
+    assert _make_call_key((1, 2), {}) != _make_call_key(((1, 2),), {})
+
+def test_call_key_ignores_kwarg_order():
+    assert _make_call_key((), {"a": 1, "b": 2}) == _make_call_key((), {"b": 2, "a": 1})
+
+def test_call_key_handles_unjsonable_dict_keys():
+    # Tuple and mixed-type dict keys defeat JSON canonicalization; key
+    # construction must never raise for a call the function itself accepts.
+    assert _make_call_key(({(1, 2): "a"},), {})
+    assert _make_call_key(({1: "a", "b": 2},), {})
+    assert _make_call_key(({(1, 2): "a"},), {}) != _make_call_key(({(3, 4): "a"},), {})
+
 def test_init():
     assert JsonCache() is not None
 